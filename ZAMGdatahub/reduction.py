@@ -0,0 +1,320 @@
+"""
+Functions for computing grouped statistics over yearly merged NetCDF files without loading them into memory.
+
+The yearly files made by `data_download.mergeNetCDFfilesByYear` are read in chunks of
+time steps, and the statistics of each file are computed in a separate process. The
+partial statistics of the files are then merged, so the memory use is bounded by the
+chunk size and the size of the grid, and not by the length of the period.
+"""
+
+import datetime
+import functools
+import multiprocessing as mp
+import re
+from pathlib import Path
+import numpy as np
+
+# merged files made by data_download.mergeNetCDFfilesByYear, e.g. spartacus-daily_Tn_oetztal_2011.nc
+YEARLY_PATTERN = re.compile(r"_(\d{4})\.nc$")
+
+SEASONS = {12: "DJF", 1: "DJF", 2: "DJF", 3: "MAM", 4: "MAM", 5: "MAM", 6: "JJA", 7: "JJA", 8: "JJA", 9: "SON", 10: "SON", 11: "SON"}
+
+
+def groupKey(time: datetime.datetime, groupby: str):
+    """Get the group a time step belongs to.
+
+    Args:
+        time (datetime.datetime): time step
+        groupby (str): one of "all", "year", "month", "season", "yearmonth" or "dayofyear"
+
+    Returns:
+        group key, e.g. the month (int) for groupby="month"
+    """
+    if groupby == "all":
+        return "all"
+    elif groupby == "year":
+        return time.year
+    elif groupby == "month":
+        return time.month
+    elif groupby == "season":
+        return SEASONS[time.month]
+    elif groupby == "yearmonth":
+        return f"{time.year}-{time.month:02d}"
+    elif groupby == "dayofyear":
+        return time.timetuple().tm_yday
+    else:
+        raise ValueError(f"Unknown groupby: {groupby}")
+
+
+class GroupStatistics:
+    """Running statistics of the values in one group, either for each grid cell or over the whole grid.
+
+    Partial statistics computed from different chunks or files are combined with `merge`,
+    which is associative, so the order in which partial results are merged does not matter.
+    Quantiles are estimated from a histogram with fixed bin edges, so that they can be
+    merged as well. Values outside the bin edges are counted in the first or last bin.
+    The histogram counts of each grid cell are int32, which holds over 200 years of
+    10-minute data per bin. Over the whole grid (a single column) they are int64, since
+    all values of the grid are counted in the same bins.
+    """
+
+    def __init__(self, ncols: int, bins=None):
+        self.count = np.zeros(ncols, dtype=np.int64)
+        self.sum = np.zeros(ncols, dtype=np.float64)
+        self.min = np.full(ncols, np.inf)
+        self.max = np.full(ncols, -np.inf)
+        self.bins = None if bins is None else np.asarray(bins, dtype=np.float64)
+        self.hist = None if bins is None else np.zeros((len(self.bins) - 1, ncols), dtype=np.int64 if ncols == 1 else np.int32)
+
+    def __repr__(self):
+        return "GroupStatistics()"
+
+    def update(self, values: np.ndarray):
+        """Add values with shape (time, ncols) to the statistics, NaN is treated as missing."""
+        valid = ~np.isnan(values)
+        self.count += valid.sum(axis=0)
+        self.sum += np.where(valid, values, 0).sum(axis=0)
+        self.min = np.minimum(self.min, np.where(valid, values, np.inf).min(axis=0))
+        self.max = np.maximum(self.max, np.where(valid, values, -np.inf).max(axis=0))
+        if self.hist is not None:
+            nbins, ncols = self.hist.shape
+            idx = np.clip(np.searchsorted(self.bins, values, side="right") - 1, 0, nbins - 1)
+            cols = np.broadcast_to(np.arange(ncols), values.shape)
+            flat = (idx * ncols + cols)[valid]
+            self.hist += np.bincount(flat, minlength=nbins * ncols).reshape(nbins, ncols)
+
+    def copy(self):
+        copied = GroupStatistics(len(self.count))
+        copied.count = self.count.copy()
+        copied.sum = self.sum.copy()
+        copied.min = self.min.copy()
+        copied.max = self.max.copy()
+        copied.bins = self.bins
+        copied.hist = None if self.hist is None else self.hist.copy()
+        return copied
+
+    def merge(self, other):
+        """Combine with the statistics of another chunk or file, returning the combined statistics."""
+        if (self.bins is None) != (other.bins is None) or (self.bins is not None and not np.array_equal(self.bins, other.bins)):
+            raise ValueError("Cannot merge statistics with different histogram bin edges.")
+        merged = GroupStatistics(len(self.count))
+        merged.count = self.count + other.count
+        merged.sum = self.sum + other.sum
+        merged.min = np.minimum(self.min, other.min)
+        merged.max = np.maximum(self.max, other.max)
+        merged.bins = self.bins
+        merged.hist = None if self.hist is None else self.hist + other.hist
+        return merged
+
+    def mean(self):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.count > 0, self.sum / self.count, np.nan)
+
+    def quantile(self, q: float):
+        """Estimate a quantile by linear interpolation within the histogram bins.
+
+        The estimate is limited to the minimum and maximum of the values.
+
+        Args:
+            q (float): quantile between 0 and 1
+
+        Returns:
+            np.ndarray: estimated quantile, NaN where there are no valid values
+        """
+        if not 0 <= q <= 1:
+            raise ValueError(f"Quantile must be between 0 and 1, got {q}.")
+        if self.hist is None:
+            raise ValueError("Quantiles require bin edges, specify bins when computing the statistics.")
+        cumulative = np.cumsum(self.hist, axis=0)
+        target = q * self.count
+        # first bin where the cumulative count reaches the target, and at least the first non-empty bin
+        idx = np.argmax(cumulative >= np.maximum(target, 1), axis=0)
+        cols = np.arange(self.hist.shape[1])
+        below = np.where(idx > 0, cumulative[idx - 1, cols], 0)
+        inbin = self.hist[idx, cols]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            fraction = np.where(inbin > 0, (target - below) / inbin, 0)
+        lower = self.bins[idx]
+        upper = self.bins[idx + 1]
+        estimate = np.clip(lower + fraction * (upper - lower), self.min, self.max)
+        return np.where(self.count > 0, estimate, np.nan)
+
+
+class GroupedStatistics:
+    """Statistics of a variable for each group of time steps, e.g. each month.
+
+    Statistics are for each grid cell, with the shape of the grid in `shape`, or over
+    the whole grid if `spatial` is True. The grid coordinates are not stored, they can
+    be taken from any of the input files.
+    """
+
+    def __init__(self, variable: str, groupby: str, shape: tuple, spatial: bool = False, bins=None):
+        self.variable = variable
+        self.groupby = groupby
+        self.shape = shape
+        self.spatial = spatial
+        self.bins = bins
+        self.groups = {}
+
+    def __repr__(self):
+        return "GroupedStatistics()"
+
+    def __str__(self):
+        return f"GroupedStatistics of {self.variable} grouped by {self.groupby}, {len(self.groups)} groups: {','.join(str(key) for key in self.keys())}"
+
+    @property
+    def ncols(self):
+        return 1 if self.spatial else int(np.prod(self.shape))
+
+    def keys(self):
+        return sorted(self.groups)
+
+    def update(self, key, values: np.ndarray):
+        """Add values with shape (time, *shape) to the statistics of a group."""
+        values = values.reshape(-1, 1) if self.spatial else values.reshape(values.shape[0], -1)
+        if key not in self.groups:
+            self.groups[key] = GroupStatistics(self.ncols, bins=self.bins)
+        self.groups[key].update(values)
+
+    def merge(self, other):
+        """Combine with the statistics of another file, returning the combined statistics."""
+        if (self.variable, self.groupby, self.shape, self.spatial) != (other.variable, other.groupby, other.shape, other.spatial):
+            raise ValueError("Cannot merge statistics of different variables, groupings or grids.")
+        if (self.bins is None) != (other.bins is None) or (self.bins is not None and not np.array_equal(self.bins, other.bins)):
+            raise ValueError("Cannot merge statistics with different histogram bin edges.")
+        merged = GroupedStatistics(self.variable, self.groupby, self.shape, spatial=self.spatial, bins=self.bins)
+        for key in set(self.groups) | set(other.groups):
+            if key in self.groups and key in other.groups:
+                merged.groups[key] = self.groups[key].merge(other.groups[key])
+            else:
+                merged.groups[key] = self.groups.get(key, other.groups.get(key)).copy()
+        return merged
+
+    def _result(self, stat):
+        shape = () if self.spatial else self.shape
+        return {key: stat(self.groups[key]).reshape(shape) for key in self.keys()}
+
+    def count(self) -> dict:
+        return self._result(lambda g: g.count)
+
+    def sum(self) -> dict:
+        return self._result(lambda g: g.sum)
+
+    def mean(self) -> dict:
+        return self._result(lambda g: g.mean())
+
+    def min(self) -> dict:
+        return self._result(lambda g: np.where(g.count > 0, g.min, np.nan))
+
+    def max(self) -> dict:
+        return self._result(lambda g: np.where(g.count > 0, g.max, np.nan))
+
+    def quantile(self, q: float) -> dict:
+        return self._result(lambda g: g.quantile(q))
+
+
+def reduceFile(file, variable: str, groupby: str = "month", spatial: bool = False, bins=None, chunksize: int = 50) -> GroupedStatistics:
+    """Compute grouped statistics of a variable in a NetCDF file, reading a chunk of time steps at a time.
+
+    Args:
+        file (str or pathlib.Path): NetCDF file with a variable with dimensions (time, y, x)
+        variable (str): name of the variable, e.g. a parameter of the query
+        groupby (str, optional): how to group the time steps, see `groupKey`. Defaults to "month".
+        spatial (bool, optional): whether to compute statistics over the whole grid instead of for each grid cell. Defaults to False.
+        bins (array-like, optional): histogram bin edges used to estimate quantiles. Defaults to None.
+        chunksize (int, optional): number of time steps read at a time. Defaults to 50.
+
+    Returns:
+        GroupedStatistics: statistics of the file
+    """
+    import netCDF4
+
+    with netCDF4.Dataset(file, "r") as ds:
+        if variable not in ds.variables:
+            raise ValueError(f"Variable {variable} not found in {file}.")
+        var = ds.variables[variable]
+        if var.dimensions[0] != "time":
+            raise ValueError(f"First dimension of {variable} in {file} is not time.")
+        timevar = ds.variables["time"]
+        times = netCDF4.num2date(
+            timevar[:],
+            timevar.units,
+            calendar=getattr(timevar, "calendar", "standard"),
+            only_use_cftime_datetimes=False,
+            only_use_python_datetimes=True,
+        )
+        keys = np.array([groupKey(t, groupby) for t in times], dtype=object)
+
+        stats = GroupedStatistics(variable, groupby, tuple(var.shape[1:]), spatial=spatial, bins=bins)
+        for i in range(0, var.shape[0], chunksize):
+            chunk = np.ma.filled(var[i:i + chunksize].astype(np.float64), np.nan)
+            chunkKeys = keys[i:i + chunksize]
+            # chunks are short, so they only span a few groups
+            for key in dict.fromkeys(chunkKeys):
+                stats.update(key, chunk[chunkKeys == key])
+    return stats
+
+
+def findYearlyFiles(DIR, pattern: str) -> list:
+    """Find the files merged by year in a directory.
+
+    Args:
+        DIR (str or pathlib.Path): directory with the merged files
+        pattern (str): glob pattern to select the files of one variable and location, e.g. "spartacus-daily_Tn_oetztal_*.nc"
+
+    Returns:
+        list: merged yearly files sorted by year
+    """
+    files = [f for f in Path(DIR).glob(pattern) if YEARLY_PATTERN.search(f.name)]
+    return sorted(files, key=lambda f: YEARLY_PATTERN.search(f.name).group(1))
+
+
+def reduceYearlyFiles(files: list, variable: str, groupby: str = "month", spatial: bool = False, bins=None, chunksize: int = 50, cores: int = None, verbose: bool = True) -> GroupedStatistics:
+    """Compute grouped statistics of a variable over many yearly files in bounded memory.
+
+    Each file is reduced in a separate process, reading `chunksize` time steps at a time,
+    and the statistics of each file are merged into the total as soon as they are done.
+    At most about `cores` + 1 partial statistics are held in memory at once, each using
+    about (32 + 4 x number of bins) bytes per grid cell and group. For example, the
+    monthly climatology of daily minimum temperature over all years:
+
+        files = reduction.findYearlyFiles(DIR, "spartacus-daily_Tn_tirol_*.nc")
+        stats = reduction.reduceYearlyFiles(files, "Tn", groupby="month", bins=np.arange(-40, 30.5, 0.5))
+        means = stats.mean()
+        medians = stats.quantile(0.5)
+
+    Args:
+        files (list): NetCDF files, e.g. made by `data_download.mergeNetCDFfilesByYear`
+        variable (str): name of the variable, e.g. a parameter of the query
+        groupby (str, optional): how to group the time steps, see `groupKey`. Defaults to "month".
+        spatial (bool, optional): whether to compute statistics over the whole grid instead of for each grid cell. Defaults to False.
+        bins (array-like, optional): histogram bin edges used to estimate quantiles. For statistics of each grid cell
+            the histograms use 4 bytes x number of bins x number of grid cells x number of groups of memory, so choose
+            few bins for large grids or use spatial=True. Defaults to None.
+        chunksize (int, optional): number of time steps read at a time. Defaults to 50.
+        cores (int, optional): number of processes. Defaults to number of cores minus one.
+        verbose (bool, optional): printed statements will be turned off if set to False. Defaults to True.
+
+    Returns:
+        GroupedStatistics: statistics of all files
+    """
+    files = [str(f) for f in files]
+    if not files:
+        raise ValueError("No files to reduce.")
+    if cores is None:
+        cores = max(1, mp.cpu_count() - 1)
+    cores = min(cores, len(files))
+    if verbose:
+        print(f"Computing statistics of {variable} grouped by {groupby} from {len(files)} files with {cores} cores.")
+    reduce = functools.partial(reduceFile, variable=variable, groupby=groupby, spatial=spatial, bins=bins, chunksize=chunksize)
+    total = None
+    if cores > 1:
+        with mp.Pool(cores) as pool:
+            # merge each partial as it arrives, so that they are not all kept in memory
+            for partial in pool.imap_unordered(reduce, files):
+                total = partial if total is None else total.merge(partial)
+    else:
+        for file in files:
+            partial = reduce(file)
+            total = partial if total is None else total.merge(partial)
+    return total
@@ -0,0 +1,432 @@
+"""
+Functions for checking the integrity of downloaded data in a local archive.
+
+A failed or interrupted download can leave an HTML error page or a truncated file
+behind under a valid filename, which `data_download.requestData` will then skip forever.
+The functions in this module check every archive file belonging to a query in parallel,
+cache a (size, mtime, hash) fingerprint of each checked file so that reruns only check
+files that changed, and return the files that should be downloaded again.
+"""
+
+import datetime
+import functools
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import re
+import csv
+from pathlib import Path
+from ZAMGdatahub import query
+
+CACHE_FILENAME = ".validation_cache.json"
+
+# time step of each dataset, used to check that the time axis is complete
+TIMESTEPS = {
+    query.DatasetType.INCA: datetime.timedelta(hours=1),
+    query.DatasetType.INCA_15min: datetime.timedelta(minutes=15),
+    query.DatasetType.INCA_POINT: datetime.timedelta(hours=1),
+    query.DatasetType.SPARTACUS: datetime.timedelta(days=1),
+    query.DatasetType.SPARTACUS_v2: datetime.timedelta(days=1),
+    query.DatasetType.SPARTACUS_POINT: datetime.timedelta(days=1),
+    query.DatasetType.SNOWGRID: datetime.timedelta(days=1),
+    query.DatasetType.WINFORE: datetime.timedelta(days=1),
+    query.DatasetType.APOLIS: datetime.timedelta(days=1),
+    query.DatasetType.STATION_10min: datetime.timedelta(minutes=10),
+    query.DatasetType.STATION_1h: datetime.timedelta(hours=1),
+}
+
+NETCDF_MAGIC = (b"CDF\x01", b"CDF\x02", b"CDF\x05", b"\x89HDF\r\n\x1a\n")
+
+# slice files made by utils.makeFilename, e.g. spartacus-daily_Tn_oetztal_201101010000-201103010000.nc
+SLICE_PATTERN = re.compile(r"_(\d{12})-(\d{12})\.(nc|csv)$")
+# station files made by utils.makeStationFilenames, with or without annual slices
+STATION_ANNUAL_PATTERN = re.compile(r"_(\d{4})\.csv$")
+STATION_PERIOD_PATTERN = re.compile(r"_(\d{8})-(\d{8})\.csv$")
+
+
+def fileHash(file, blocksize=1 << 20):
+    """Compute the hash of a file's content.
+
+    Args:
+        file (str or pathlib.Path): file to hash
+        blocksize (int, optional): number of bytes read at a time. Defaults to 1 MiB.
+
+    Returns:
+        str: hexadecimal BLAKE2b digest of the file
+    """
+    h = hashlib.blake2b(digest_size=16)
+    with open(file, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def checkNetCDFfile(file, params: list, start: datetime.datetime = None, end: datetime.datetime = None, timestep: datetime.timedelta = None, openEnd: bool = False) -> list:
+    """Check that a NetCDF file is intact and contains the requested data.
+
+    Checks that the header parses, that all `params` are variables in the file, that
+    the last time step of each variable can be read (which catches truncated files) and,
+    if `start`, `end` and `timestep` are given, that every time step of the slice is present.
+
+    Args:
+        file (str or pathlib.Path): NetCDF file to check
+        params (list): parameters requested in the query
+        start (datetime.datetime, optional): first time step of the slice. Defaults to None.
+        end (datetime.datetime, optional): end of the slice. Defaults to None.
+        timestep (datetime.timedelta, optional): time step of the dataset. Defaults to None.
+        openEnd (bool, optional): whether data may not yet be published up to `end`, see `checkTimeAxis`. Defaults to False.
+
+    Returns:
+        list: problems found in the file, empty if the file is valid
+    """
+    import netCDF4
+
+    with open(file, "rb") as f:
+        magic = f.read(8)
+    if not magic.startswith(NETCDF_MAGIC):
+        if magic.lstrip().startswith(b"<"):
+            return ["not a NetCDF file, looks like an HTML/XML error page"]
+        return ["not a NetCDF file"]
+
+    problems = []
+    try:
+        with netCDF4.Dataset(file, "r") as ds:
+            missing = [par for par in params if par not in ds.variables]
+            if missing:
+                problems.append(f"missing variables: {','.join(missing)}")
+            for par in params:
+                if par in ds.variables and ds.variables[par].size > 0:
+                    # reading the last value fails if the file is truncated
+                    ds.variables[par][(-1,) * ds.variables[par].ndim]
+
+            if start is not None and end is not None and timestep is not None:
+                if "time" not in ds.variables:
+                    problems.append("no time variable")
+                else:
+                    timevar = ds.variables["time"]
+                    times = netCDF4.num2date(
+                        timevar[:],
+                        timevar.units,
+                        calendar=getattr(timevar, "calendar", "standard"),
+                        only_use_cftime_datetimes=False,
+                        only_use_python_datetimes=True,
+                    )
+                    problems += checkTimeAxis(times, start, end, timestep, openEnd=openEnd)
+    except (OSError, RuntimeError, ValueError, IndexError, AttributeError) as e:
+        problems.append(f"failed to read NetCDF: {e}")
+    return problems
+
+
+def checkTimeAxis(times, start: datetime.datetime, end: datetime.datetime, timestep: datetime.timedelta, openEnd: bool = False) -> list:
+    """Check that all time steps from `start` up to `end` are present.
+
+    The end of the slice is allowed to be either included or excluded, since the
+    slices overlap at their boundaries. If `openEnd` is True, e.g. for the last slice
+    of a download up to the present, data may not have been published up to `end`
+    yet, and only the time steps from `start` up to the last time step in the file
+    are required.
+
+    Args:
+        times (iterable): time steps in the file as datetime.datetime
+        start (datetime.datetime): first time step of the slice
+        end (datetime.datetime): end of the slice
+        timestep (datetime.timedelta): time step of the dataset
+        openEnd (bool, optional): whether the time axis may end before `end`. Defaults to False.
+
+    Returns:
+        list: problems found in the time axis, empty if it is complete
+    """
+    present = set(times)
+    if openEnd:
+        last = max([t for t in present if start <= t <= end], default=start)
+        end = last + timestep
+    expected = int((end - start) / timestep)
+    missing = [start + i * timestep for i in range(expected) if start + i * timestep not in present]
+    if missing:
+        return [f"{len(missing)} of {expected} time steps missing, first missing {missing[0]:%Y-%m-%d %H:%M}"]
+    return []
+
+
+def checkCSVfile(file, params: list, minRows: int = 1, maxRows: int = None) -> list:
+    """Check the header and number of rows of a CSV file.
+
+    Every row must have as many fields as the header, and the file must end with a
+    newline, so that a truncated file is found even if its number of rows is unknown.
+
+    Args:
+        file (str or pathlib.Path): CSV file to check
+        params (list): parameters requested in the query, must all be columns in the header
+        minRows (int, optional): minimum number of data rows. Defaults to 1.
+        maxRows (int, optional): maximum number of data rows. Defaults to None.
+
+    Returns:
+        list: problems found in the file, empty if the file is valid
+    """
+    if os.path.getsize(file) == 0:
+        return ["empty file"]
+    problems = []
+    with open(file, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b"\n":
+            problems.append("file does not end with a newline, probably truncated")
+    with open(file, "r", newline="", errors="replace") as f:
+        firstline = f.readline()
+        if firstline.lstrip().startswith("<"):
+            return ["not a CSV file, looks like an HTML/XML error page"]
+        header = next(csv.reader([firstline]), [])
+        if not header or header[0].strip() != "time":
+            problems.append("header does not start with a time column")
+        missing = [par for par in params if par not in header]
+        if missing:
+            problems.append(f"missing columns: {','.join(missing)}")
+        rows = 0
+        badRows = 0
+        for row in csv.reader(f):
+            if not row:
+                continue
+            rows += 1
+            if len(row) != len(header):
+                badRows += 1
+        if badRows:
+            problems.append(f"{badRows} rows do not have {len(header)} fields")
+    if rows < minRows:
+        problems.append(f"{rows} rows, expected at least {minRows}")
+    if maxRows is not None and rows > maxRows:
+        problems.append(f"{rows} rows, expected at most {maxRows}")
+    return problems
+
+
+def checkFile(task: dict) -> dict:
+    """Check a single archive file, skipping the check if its content is unchanged.
+
+    Intended to be run in a worker process by `validateArchive`.
+
+    Args:
+        task (dict): file, check arguments, and the cached entry of the file (or None)
+
+    Returns:
+        dict: cache entry with size, mtime, hash, check key and found problems
+    """
+    file = task["file"]
+    stat = os.stat(file)
+    cached = task["cached"]
+    entry = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "key": task["key"]}
+    try:
+        entry["hash"] = fileHash(file)
+    except OSError as e:
+        entry["hash"] = None
+        entry["problems"] = [f"failed to read file: {e}"]
+        return entry
+    # file was touched but content is the same
+    if cached is not None and cached.get("hash") == entry["hash"] and cached.get("key") == entry["key"]:
+        entry["problems"] = cached["problems"]
+        return entry
+
+    openEnd = task["openEnd"]
+    minRows = 1 if openEnd else task["minRows"]
+
+    if stat.st_size == 0:
+        entry["problems"] = ["empty file"]
+    elif task["format"] == "netcdf":
+        entry["problems"] = checkNetCDFfile(file, task["params"], task["start"], task["end"], task["timestep"], openEnd=openEnd)
+    else:
+        entry["problems"] = checkCSVfile(file, task["params"], minRows, task["maxRows"])
+    return entry
+
+
+@functools.lru_cache(maxsize=None)
+def _parseStamp(stamp):
+    # much faster than strptime for the compact "%Y%m%d%H%M" stamps in the filenames
+    return datetime.datetime(int(stamp[:4]), int(stamp[4:6]), int(stamp[6:8]), int(stamp[8:10]), int(stamp[10:12]))
+
+
+def _listFiles(DIR, subdir, head, extension):
+    # os.scandir on plain strings is much faster than Path.glob for large directories
+    try:
+        with os.scandir(os.path.join(DIR, subdir)) as entries:
+            names = sorted(entry.name for entry in entries if entry.name.startswith(head + "_") and entry.name.endswith("." + extension))
+    except FileNotFoundError:
+        return []
+    return [(os.path.join(DIR, subdir, name), f"{subdir}/{name}" if subdir else name) for name in names]
+
+
+def makeValidationTasks(ZAMGquery, DIR, publicationLag: datetime.timedelta = datetime.timedelta(days=31)) -> list:
+    """Find the archive files belonging to a query and what to check for each of them.
+
+    Args:
+        ZAMGquery (ZAMGdatahub.query.RasterQuery or ZAMGdatahub.query.StationQuery): the query used to download the data
+        DIR (str or pathlib.Path): directory the data was downloaded to
+        publicationLag (datetime.timedelta, optional): slices ending less than this before now are only required
+            to have data up to their last time step. Defaults to 31 days.
+
+    Returns:
+        list: tasks (dicts) to pass to `checkFile`
+    """
+    DIR = str(DIR)
+    extension = {"netcdf": "nc", "csv": "csv"}[ZAMGquery.output_format]
+    timestep = TIMESTEPS.get(ZAMGquery.dataset)
+    now = datetime.datetime.now()
+    tasks = []
+    # the part of the check key that is the same for all files, see `validateArchive`
+    queryKey = f"{','.join(ZAMGquery.params)}|{ZAMGquery.output_format}|{timestep}"
+
+    def addTask(file, name, sliceKey, start=None, end=None, minRows=1, maxRows=None):
+        # data of slices ending recently, e.g. downloaded up to the present, may not have been published yet
+        openEnd = end is not None and end > now - publicationLag
+        key = f"{queryKey}|{sliceKey}|{minRows}|{maxRows}|{openEnd}"
+        tasks.append({
+            "file": file,
+            "name": name,
+            "format": ZAMGquery.output_format,
+            "params": ZAMGquery.params,
+            "start": start,
+            "end": end,
+            "timestep": timestep,
+            "minRows": minRows,
+            "maxRows": maxRows,
+            "openEnd": openEnd,
+            "key": key,
+        })
+
+    def stepsBetween(start, end):
+        # number of time steps from start to end, both included
+        return int((end - start) / timestep) + 1
+
+    if isinstance(ZAMGquery, query.StationQuery):
+        for station, name, stationStart, subdir in zip(ZAMGquery.station_ids, ZAMGquery.station_names, ZAMGquery.station_starts, ZAMGquery.station_longnames):
+            stationStart = datetime.datetime.strptime(stationStart[:10], "%Y-%m-%d")
+            head = "_".join([station, name.replace("/", "-").replace(" ", "-"), ZAMGquery.output_filename_head])
+            if ZAMGquery.annualSlices:
+                files = _listFiles(DIR, subdir, head, "csv")
+                years = [(f, name, int(m.group(1))) for f, name in files for m in [STATION_ANNUAL_PATTERN.search(name)] if m]
+                lastYear = max([year for f, name, year in years], default=None)
+                for f, name, year in years:
+                    s = max(stationStart, datetime.datetime(year, 1, 1, 0, 0))
+                    e = datetime.datetime(year, 12, 31, 23, 59)
+                    maxRows = stepsBetween(s, e)
+                    # the last year may have been requested only up to some date
+                    minRows = 1 if year == lastYear else maxRows
+                    addTask(f, name, f"{s}|{year}", minRows=minRows, maxRows=maxRows)
+            else:
+                for f, name in _listFiles(DIR, "", head, "csv"):
+                    m = STATION_PERIOD_PATTERN.search(name)
+                    if m:
+                        s, e = _parseStamp(m.group(1) + "0000"), _parseStamp(m.group(2) + "2359")
+                        addTask(f, name, f"{stationStart}|{m.group(0)}", maxRows=stepsBetween(max(s, stationStart), e))
+    else:
+        head = "_".join([ZAMGquery.output_filename_head, ",".join(ZAMGquery.params), ZAMGquery.location_label])
+        for f, name in _listFiles(DIR, "", head, extension):
+            m = SLICE_PATTERN.search(name)
+            # merged yearly files are skipped, they are made from the slices
+            if m is None:
+                continue
+            s, e = _parseStamp(m.group(1)), _parseStamp(m.group(2))
+            if ZAMGquery.output_format == "netcdf":
+                addTask(f, name, m.group(0), start=s, end=e)
+            else:
+                # end of the slice may or may not be included
+                addTask(f, name, m.group(0), end=e, minRows=stepsBetween(s, e) - 1, maxRows=stepsBetween(s, e))
+    return tasks
+
+
+def loadValidationCache(file) -> dict:
+    """Load the fingerprint cache, returning an empty cache if it is missing or corrupt."""
+    try:
+        with open(file, "r") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def saveValidationCache(cache: dict, file):
+    """Save the fingerprint cache, replacing the old cache only once writing has succeeded."""
+    tmp = str(file) + ".tmp"
+    with open(tmp, "w") as f:
+        # json.dumps uses the C encoder, json.dump does not
+        f.write(json.dumps(cache))
+    os.replace(tmp, file)
+
+
+def validateArchive(ZAMGquery, DIR, cores: int = None, useCache: bool = True, verbose: bool = True, publicationLag: datetime.timedelta = datetime.timedelta(days=31)) -> list:
+    """Check all files downloaded for a query in a directory and list those that need to be downloaded again.
+
+    Files whose size and modification time are unchanged since the last check are not
+    read again. Changed files are hashed, and only checked if their content changed.
+    The fingerprints are cached in a file in `DIR`. Slices ending less than `publicationLag`
+    before now are checked on every run, and are required to be complete once their end
+    is older than that.
+
+    To download the returned files again, delete them or run `data_download.downloadData`
+    for their time slices with `overwrite=True`.
+
+    Args:
+        ZAMGquery (ZAMGdatahub.query.RasterQuery or ZAMGdatahub.query.StationQuery): the query used to download the data
+        DIR (str or pathlib.Path): directory the data was downloaded to
+        cores (int, optional): number of processes used to check the files. Defaults to number of cores minus one.
+        useCache (bool, optional): whether to use and update the fingerprint cache. Defaults to True.
+        verbose (bool, optional): printed statements will be turned off if set to False. Defaults to True.
+        publicationLag (datetime.timedelta, optional): slices ending less than this before now, e.g. downloaded up to the
+            present, are only required to have data up to their last time step, since recent data may not be published yet.
+            Defaults to 31 days.
+
+    Returns:
+        list: files (pathlib.Path) that are invalid and should be downloaded again
+    """
+    DIR = Path(DIR)
+    cacheFile = DIR.joinpath(CACHE_FILENAME)
+    cache = loadValidationCache(cacheFile) if useCache else {}
+
+    tasks = makeValidationTasks(ZAMGquery, DIR, publicationLag=publicationLag)
+    results = {}
+    toCheck = []
+    for task in tasks:
+        cached = cache.get(task["name"])
+        stat = os.stat(task["file"])
+        if (
+            cached is not None
+            and not task["openEnd"]
+            and cached["size"] == stat.st_size
+            and cached["mtime"] == stat.st_mtime_ns
+            and cached["key"] == task["key"]
+        ):
+            results[task["name"]] = cached
+        else:
+            # open ended slices are checked again, since more data may have been published by now
+            task["cached"] = None if task["openEnd"] else cached
+            toCheck.append(task)
+
+    if verbose:
+        print(f"{len(tasks)} files found, {len(toCheck)} new or changed since last check.")
+
+    if toCheck:
+        if cores is None:
+            cores = max(1, mp.cpu_count() - 1)
+        cores = min(cores, len(toCheck))
+        if cores > 1:
+            with mp.Pool(cores) as pool:
+                entries = pool.map(checkFile, toCheck, chunksize=max(1, len(toCheck) // (cores * 4)))
+        else:
+            entries = [checkFile(task) for task in toCheck]
+        for task, entry in zip(toCheck, entries):
+            results[task["name"]] = entry
+
+    if useCache:
+        # drop entries of files that no longer exist, the cache may also hold files of other queries
+        removed = [name for name in cache if name not in results and not DIR.joinpath(name).is_file()]
+        for name in removed:
+            del cache[name]
+        changed = {name: entry for name, entry in results.items() if cache.get(name) != entry}
+        if removed or changed:
+            cache.update(changed)
+            saveValidationCache(cache, cacheFile)
+
+    invalid = []
+    for name, entry in sorted(results.items()):
+        if entry["problems"]:
+            invalid.append(DIR.joinpath(name))
+            if verbose:
+                print(f"{name}: {'; '.join(entry['problems'])}")
+    if verbose:
+        print(f"{len(invalid)} of {len(tasks)} files need to be downloaded again.")
+    return invalid